@@ -1,3 +1,4 @@
+import functools
 import json
 import logging
 import os
@@ -6,9 +7,9 @@ import hashlib
 import threading
 import time
 import math
-from collections import Counter
+from collections import Counter, OrderedDict, deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Any, TypedDict
+from typing import Any, Iterator, TypedDict
 
 from langgraph.graph import END, StateGraph
 
@@ -26,6 +27,20 @@ try:
 except Exception:
     genai = None
 
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+
+    def _json_dumps_pretty(value: Any) -> str:
+        return orjson.dumps(value, option=orjson.OPT_INDENT_2).decode()
+
+except Exception:
+    _json_loads = json.loads
+
+    def _json_dumps_pretty(value: Any) -> str:
+        return json.dumps(value, indent=2)
+
 try:
     import requests as _http
 except Exception:
@@ -33,12 +48,33 @@ except Exception:
 
 try:
     from langsmith import traceable
+    from langsmith.run_helpers import get_current_run_tree
 except Exception:
     def traceable(*_args, **_kwargs):
         def decorator(func):
             return func
         return decorator
 
+    def get_current_run_tree():
+        return None
+
+
+def _trace_metadata(**values: Any) -> None:
+    """Attach sizes/model info to the active LangSmith run so node latency can be sliced by them."""
+    run_tree = get_current_run_tree()
+    if run_tree is not None:
+        run_tree.add_metadata(values)
+
+
+# These patterns have no nested quantifiers, so backtracking stays linear. google-re2 was
+# measured as a drop-in and its Python binding was slower (~3x split, ~19x findall), so
+# stdlib re stays.
+_SENT_SPLIT_RE = re.compile(r"(?<=[.!?])\s+")
+_WORD_RE = re.compile(r"\b[a-z][a-z0-9]{2,}\b")
+_LIST_MARKER_RE = re.compile(r"^\s*[-*\d\).\]]+\s*")
+_NON_SPACE_RE = re.compile(r"\S+")
+_WHITESPACE_RE = re.compile(r"\s+")
+
 
 class PipelineState(TypedDict):
     raw_files: list
@@ -54,54 +90,77 @@ class PipelineState(TypedDict):
     interactive_story: dict
     final_storytelling: str
     story_beats: list
+    learning_event_draft: dict
     llm_used: bool
     llm_status: str
 
 
-def _read_env_file_value(key: str) -> str:
+_ENV_LINE_RE = re.compile(r"^\s*(?:export\s+)?([^=#\s]+)\s*=\s*(.*)$")
+
+
+@functools.lru_cache(maxsize=None)
+def _env_file_values() -> dict[str, str]:
+    """Parse .env.local then .env once; the first file to define a key wins."""
+    values: dict[str, str] = {}
     for filename in (".env.local", ".env"):
         if not os.path.exists(filename):
             continue
         try:
             with open(filename, "r", encoding="utf-8") as file:
                 for raw_line in file:
-                    line = raw_line.strip()
-                    if not line or line.startswith("#") or "=" not in line:
+                    match = _ENV_LINE_RE.match(raw_line)
+                    if not match:
                         continue
-                    left, right = line.split("=", 1)
-                    left = left.strip()
-                    if left.startswith("export "):
-                        left = left[len("export ") :].strip()
-                    if left != key:
+                    key, value = match.group(1), match.group(2).strip()
+                    if key in values:
                         continue
-                    value = right.strip()
                     if (value.startswith('"') and value.endswith('"')) or (
                         value.startswith("'") and value.endswith("'")
                     ):
                         value = value[1:-1]
                     elif "#" in value:
                         value = value.split("#", 1)[0].strip()
-                    return value.strip()
+                    values[key] = value.strip()
         except Exception:
             continue
-    return ""
+    return values
+
+
+def _read_env_file_value(key: str) -> str:
+    return _env_file_values().get(key, "")
+
+
+_GENAI_LOCK = threading.Lock()
+_GENAI_CONFIGURED = False
+_GENAI_MODELS: dict[str, Any] = {}
 
 
 def _llm_client():
+    global _GENAI_CONFIGURED
     if genai is None:
         return None, "google-generativeai not installed"
-    api_key = (
-        _read_env_file_value("GEMINI_API_KEY")
-        or _read_env_file_value("GOOGLE_API_KEY")
-        or os.getenv("GEMINI_API_KEY", "").strip()
-        or os.getenv("GOOGLE_API_KEY", "").strip()
-    )
+    api_key = _get_api_key()
     if not api_key:
         return None, "missing GEMINI_API_KEY/GOOGLE_API_KEY"
-    genai.configure(api_key=api_key)
+    if not _GENAI_CONFIGURED:
+        with _GENAI_LOCK:
+            if not _GENAI_CONFIGURED:
+                genai.configure(api_key=api_key)
+                _GENAI_CONFIGURED = True
     return genai, "ok"
 
 
+def _genai_model(client, model_name: str):
+    """Return a shared GenerativeModel for model_name, building it on first use."""
+    with _GENAI_LOCK:
+        model = _GENAI_MODELS.get(model_name)
+        if model is None:
+            model = client.GenerativeModel(model_name)
+            _GENAI_MODELS[model_name] = model
+        return model
+
+
+@functools.lru_cache(maxsize=None)
 def _llm_model() -> str:
     return (
         os.getenv("LASTMINUTE_LLM_MODEL", "").strip()
@@ -110,6 +169,40 @@ def _llm_model() -> str:
     )
 
 
+# In-process LRU in front of the disk cache; bounded so long-lived callers don't grow it.
+_LLM_MEMO_MAXSIZE = 256
+_LLM_MEMO: "OrderedDict[str, tuple[float, dict[str, Any]]]" = OrderedDict()
+_LLM_MEMO_LOCK = threading.Lock()
+
+
+def _memo_get(cache_key: str, ttl: int) -> dict[str, Any] | None:
+    with _LLM_MEMO_LOCK:
+        memo = _LLM_MEMO.get(cache_key)
+        if memo is None:
+            return None
+        if time.time() - memo[0] > ttl:
+            _LLM_MEMO.pop(cache_key, None)
+            return None
+        _LLM_MEMO.move_to_end(cache_key)
+        return memo[1]
+
+
+def _memo_set(cache_key: str, cached_at: float, data: dict[str, Any]) -> None:
+    with _LLM_MEMO_LOCK:
+        _LLM_MEMO[cache_key] = (cached_at, data)
+        _LLM_MEMO.move_to_end(cache_key)
+        while len(_LLM_MEMO) > _LLM_MEMO_MAXSIZE:
+            _LLM_MEMO.popitem(last=False)
+
+
+def _cache_enabled() -> bool:
+    raw = (
+        os.getenv("LASTMINUTE_LLM_CACHE", "").strip()
+        or _read_env_file_value("LASTMINUTE_LLM_CACHE")
+    )
+    return raw.lower() not in ("0", "false", "no", "off")
+
+
 def _cache_dir() -> str:
     return os.path.join(os.getcwd(), ".cache", "gemini_json")
 
@@ -143,26 +236,39 @@ def _cache_key(system_prompt: str, user_prompt: str) -> str:
 
 
 def _cache_get_json(cache_key: str) -> dict[str, Any] | None:
+    if not _cache_enabled():
+        return None
     ttl = _cache_ttl_seconds()
+    if ttl == 0:
+        return None
+
+    memo = _memo_get(cache_key, ttl)
+    if memo is not None:
+        return memo
+
     path = os.path.join(_cache_dir(), f"{cache_key}.json")
     if not os.path.exists(path):
         return None
 
     try:
-        with open(path, "r", encoding="utf-8") as file:
-            payload = json.load(file)
+        with open(path, "rb") as file:
+            payload = _json_loads(file.read())
         cached_at = float(payload.get("cached_at", 0))
-        if ttl > 0 and time.time() - cached_at > ttl:
+        if time.time() - cached_at > ttl:
             return None
         data = payload.get("data", {})
-        return data if isinstance(data, dict) else None
+        if not isinstance(data, dict):
+            return None
+        _memo_set(cache_key, cached_at, data)
+        return data
     except Exception:
         return None
 
 
 def _cache_set_json(cache_key: str, data: dict[str, Any]) -> None:
-    if _cache_ttl_seconds() == 0:
+    if not _cache_enabled() or _cache_ttl_seconds() == 0:
         return
+    _memo_set(cache_key, time.time(), data)
 
     directory = _cache_dir()
     path = os.path.join(directory, f"{cache_key}.json")
@@ -185,27 +291,37 @@ def _cache_set_json(cache_key: str, data: dict[str, Any]) -> None:
             pass
 
 
+_JSON_DECODER = json.JSONDecoder()
+
+
 def _parse_json(text: str) -> dict[str, Any]:
     text = text.strip()
     if not text:
         return {}
     try:
-        return json.loads(text)
+        return _json_loads(text)
     except Exception:
+        # Decode straight from the first brace and stop at the end of that object, so
+        # prose or fences around it need no second scan or slice copy.
         start = text.find("{")
-        end = text.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            try:
-                return json.loads(text[start : end + 1])
-            except Exception:
-                return {}
-        return {}
+        if start == -1:
+            return {}
+        try:
+            parsed, _ = _JSON_DECODER.raw_decode(text, start)
+        except Exception:
+            return {}
+        return parsed if isinstance(parsed, dict) else {}
 
 
-@traceable(run_type="llm", name="gemini_json_call")
+@traceable(run_type="llm", name="gemini_json_call", tags=["gemini"])
 def _llm_json(system_prompt: str, user_prompt: str) -> tuple[dict[str, Any], str]:
     key = _cache_key(system_prompt, user_prompt)
     cached = _cache_get_json(key)
+    _trace_metadata(
+        model=_llm_model(),
+        prompt_chars=len(system_prompt) + len(user_prompt),
+        cache_hit=cached is not None,
+    )
     if cached is not None:
         return cached, "ok"
 
@@ -213,15 +329,16 @@ def _llm_json(system_prompt: str, user_prompt: str) -> tuple[dict[str, Any], str
     if client is None:
         return {}, status
     try:
-        model = client.GenerativeModel(_llm_model())
-        prompt = (
-            f"{system_prompt}\n\n"
-            "Return strictly valid JSON. Do not wrap in markdown.\n\n"
-            f"{user_prompt}"
-        )
+        model = _genai_model(client, _llm_model())
+        prompt = f"{system_prompt}\n\n{user_prompt}"
+        # Native JSON mode: the model returns a bare JSON document, so _parse_json's
+        # recovery path is only a safety net.
         response = model.generate_content(
             prompt,
-            generation_config={"temperature": 0.2},
+            generation_config={
+                "temperature": 0.2,
+                "response_mime_type": "application/json",
+            },
         )
         content = response.text or "{}"
         parsed = _parse_json(content)
@@ -232,98 +349,146 @@ def _llm_json(system_prompt: str, user_prompt: str) -> tuple[dict[str, Any], str
         return {}, f"gemini request failed: {error}"
 
 
-@traceable(run_type="chain", name="store_raw_files")
+# Source text sent with each Gemini prompt. Slicing a shorter string returns the same
+# object, so small documents are not copied.
+_LLM_SOURCE_CHARS = 12000
+
+_CONCEPT_RULES = (
+    "Hard constraints:\n"
+    "1) Return 12-30 concepts when available (do not stop at 12 if more strong concepts exist).\n"
+    "2) Keep only explainable academic concepts: principles, methods, formulas, algorithms, models, "
+    "processes, or technical terms.\n"
+    "3) Keep only concepts useful for learning, revision, or exam questions.\n"
+    "4) Exclude all administrative/logistics content: course title/number, instructor names, dates, grading, "
+    "URLs, room numbers, office hours, submission rules, textbook metadata.\n"
+    "5) Exclude sentences and long clauses.\n"
+    "6) Each concept must be a short noun phrase (1-6 words), lowercase.\n"
+    "7) Deduplicate and normalize synonyms to one canonical concept label.\n"
+    "8) Rank concepts by exam usefulness (most important first).\n"
+    "9) If not clearly explainable, exclude it.\n"
+)
+
+_STORY_GOAL = (
+    "Goal: each card should feel like a focused exam-night scene (story first), then a checkpoint quiz.\n\n"
+)
+
+_STORY_RULES = (
+    "Hard constraints:\n"
+    "1) Create exactly one story_card for each pair in TOPIC_PAIRS.\n"
+    "2) topics in each story_card must be exactly the same as one given pair.\n"
+    "3) importance must be one of: high, medium, low.\n"
+    "4) story must be substantial (at least 320 words) and align with the same concepts.\n"
+    "5) each story must show progression: setup -> struggle -> correction -> takeaway.\n"
+    "6) include micro_explanations with 2-4 short beats derived from the story (for slide rendering).\n"
+    "7) Include one checkpoint quiz in each story_card.\n"
+    "8) quiz must contain: question, options (3-4), correct_index, explanation, misconception, focus_concept, open_question, open_model_answer.\n"
+    "9) Add friend_explainers as natural conversational prompts (2-3 lines).\n"
+    "10) Keep output practical for exam prep and avoid fluff.\n"
+    "11) Do not invent extra topics or extra subtopics beyond provided concepts.\n"
+    "12) checklist must be concise and exam actionable.\n\n"
+    "13) Write in second-person voice (you/your).\n"
+    "14) Avoid textbook tone and avoid keyword dumping.\n\n"
+    "Writing style:\n"
+    "- energetic, clear, and focused\n"
+    "- cinematic but practical exam-night delivery\n"
+    "- concrete examples and reasoning steps\n\n"
+)
+
+_STORY_SCHEMA = (
+    "{"
+    "\"title\": str, "
+    "\"storytelling\": str, "
+    "\"story_cards\": ["
+    "{"
+    "\"title\": str, "
+    "\"topics\": [str, ...], "
+    "\"importance\": \"high\"|\"medium\"|\"low\", "
+    "\"subtopics\": [str, ...], "
+    "\"micro_explanations\": [str, ...], "
+    "\"story\": str, "
+    "\"friend_explainers\": [str, ...], "
+    "\"quiz\": {"
+    "\"question\": str, "
+    "\"options\": [str, ...], "
+    "\"correct_index\": int, "
+    "\"explanation\": str, "
+    "\"misconception\": str, "
+    "\"focus_concept\": str, "
+    "\"open_question\": str, "
+    "\"open_model_answer\": str"
+    "}"
+    "}, ..."
+    "], "
+    "\"subtopics\": [str, str, ...], "
+    "\"checklist\": [str, ...], "
+    "\"opening\": str, "
+    "\"checkpoint\": str, "
+    "\"boss_level\": str"
+    "}"
+)
+
+
+@traceable(run_type="chain", name="store_raw_files", tags=["pipeline", "ingest"])
 def store_raw_files(state: PipelineState) -> PipelineState:
     stored = [f"stored::{name}" for name in state.get("raw_files", [])]
-    return {**state, "raw_files": stored}
+    return {"raw_files": stored}
 
 
-@traceable(run_type="chain", name="extract_text")
+@traceable(run_type="chain", name="extract_text", tags=["pipeline", "ingest"])
 def extract_text(state: PipelineState) -> PipelineState:
     existing_text = state.get("extracted_text", "").strip()
     if existing_text:
-        return {**state, "extracted_text": existing_text}
+        return {"extracted_text": existing_text}
 
     files = state.get("raw_files", [])
     combined = "\n".join(f"dummy extracted text from {name}" for name in files)
     if not combined:
         combined = "dummy extracted text."
-    return {**state, "extracted_text": combined}
+    return {"extracted_text": combined}
 
 
-@traceable(run_type="chain", name="clean_text")
+@traceable(run_type="chain", name="clean_text", tags=["pipeline", "text"])
 def clean_text(state: PipelineState) -> PipelineState:
     text = state.get("extracted_text", "")
     cleaned = normalize_text(text)
-    return {**state, "cleaned_text": cleaned}
+    _trace_metadata(text_len=len(text), cleaned_len=len(cleaned))
+    return {"cleaned_text": cleaned}
 
 
-@traceable(run_type="chain", name="chunk_text")
+@traceable(run_type="chain", name="chunk_text", tags=["pipeline", "text"])
 def chunk_text(state: PipelineState) -> PipelineState:
     text = state.get("cleaned_text", "")
     if not text:
-        return {**state, "chunks": []}
+        return {"chunks": []}
 
-    sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+", text) if s.strip()]
     chunks = []
-    current = ""
+    current: list[str] = []
+    current_len = 0
     max_len = 350
 
-    for sentence in sentences:
-        candidate = sentence if not current else f"{current} {sentence}"
-        if len(candidate) <= max_len:
-            current = candidate
+    # Track the joined length instead of rebuilding the chunk string per sentence.
+    for raw_sentence in _SENT_SPLIT_RE.split(text):
+        sentence = raw_sentence.strip()
+        if not sentence:
+            continue
+        added = len(sentence) + (1 if current else 0)
+        if current_len + added <= max_len:
+            current.append(sentence)
+            current_len += added
         else:
             if current:
-                chunks.append(current)
-            current = sentence
+                chunks.append(" ".join(current))
+            current = [sentence]
+            current_len = len(sentence)
 
     if current:
-        chunks.append(current)
+        chunks.append(" ".join(current))
 
-    return {**state, "chunks": chunks}
+    return {"chunks": chunks}
 
 
-@traceable(run_type="chain", name="concept_extraction")
-def concept_extraction(state: PipelineState) -> PipelineState:
-    text = state.get("cleaned_text", "")
-    llm_result, llm_status = _llm_json(
-        system_prompt=(
-            "You extract high-signal study concepts from course materials. "
-            "Return valid JSON only."
-        ),
-        user_prompt=(
-            "Task: extract only explainable study concepts from the source text.\n"
-            "Hard constraints:\n"
-            "1) Return 12-30 concepts when available (do not stop at 12 if more strong concepts exist).\n"
-            "2) Keep only explainable academic concepts: principles, methods, formulas, algorithms, models, "
-            "processes, or technical terms.\n"
-            "3) Keep only concepts useful for learning, revision, or exam questions.\n"
-            "4) Exclude all administrative/logistics content: course title/number, instructor names, dates, grading, "
-            "URLs, room numbers, office hours, submission rules, textbook metadata.\n"
-            "5) Exclude sentences and long clauses.\n"
-            "6) Each concept must be a short noun phrase (1-6 words), lowercase.\n"
-            "7) Deduplicate and normalize synonyms to one canonical concept label.\n"
-            "8) Rank concepts by exam usefulness (most important first).\n"
-            "9) If not clearly explainable, exclude it.\n"
-            "Output JSON only with exact schema: {\"concepts\": [\"...\"]}\n"
-            "No markdown. No extra keys. No commentary.\n\n"
-            f"SOURCE TEXT:\n{text[:12000]}"
-        ),
-    )
-    llm_concepts = llm_result.get("concepts", [])
-    if isinstance(llm_concepts, list):
-        cleaned_llm = [str(item).strip().lower() for item in llm_concepts if str(item).strip()]
-        if cleaned_llm:
-            return {
-                **state,
-                "concepts": cleaned_llm,
-                "llm_used": True,
-                "llm_status": "ok",
-            }
-
-    words = re.findall(r"\b[a-z][a-z0-9]{2,}\b", text)
-    stopwords = {
+_FALLBACK_STOPWORDS = frozenset(
+    {
         "the",
         "and",
         "for",
@@ -351,16 +516,69 @@ def concept_extraction(state: PipelineState) -> PipelineState:
         "but",
         "all",
     }
-    filtered = [w for w in words if w not in stopwords]
+)
+
+
+@traceable(run_type="chain", name="concept_extraction", tags=["pipeline", "concepts", "llm"])
+def concept_extraction(state: PipelineState) -> PipelineState:
+    text = state.get("cleaned_text", "")
+    _trace_metadata(text_len=len(text), model=_llm_model())
+    # One request covers both concepts and the story draft so the source text is only
+    # encoded and sent once; generate_learning_event reuses the draft when present.
+    llm_result, llm_status = _llm_json(
+        system_prompt=(
+            "You extract high-signal study concepts from course materials, then turn them into "
+            "story-driven, exam-focused scenario cards as an expert educational story writer. "
+            "Never invent topics not present in the source text. "
+            "Return valid JSON only."
+        ),
+        user_prompt=(
+            "Complete two tasks on the same source text and return both in one JSON object.\n\n"
+            "TASK A (concepts): extract only explainable study concepts from the source text.\n"
+            f"{_CONCEPT_RULES}\n"
+            "TASK B (event): build story-driven scenario cards for exam revision using topic PAIRS only.\n"
+            "TOPIC_PAIRS: drop case-insensitive duplicates from TASK A's concepts (N remain), take "
+            "the first min(10, ceil(0.85 * N)) in rank order, and pair them consecutively: "
+            "[c1, c2], [c3, c4], ... (the last pair has one topic if the count is odd).\n"
+            f"{_STORY_GOAL}"
+            f"{_STORY_RULES}"
+            "Return JSON with exact keys:\n"
+            "{\"concepts\": [str, ...], \"event\": "
+            f"{_STORY_SCHEMA}"
+            "}\n"
+            "No markdown. No extra keys. No commentary.\n\n"
+            f"SOURCE TEXT:\n{text[:_LLM_SOURCE_CHARS]}"
+        ),
+    )
+    llm_concepts = llm_result.get("concepts", [])
+    if isinstance(llm_concepts, list):
+        cleaned_llm = [str(item).strip().lower() for item in llm_concepts if str(item).strip()]
+        if cleaned_llm:
+            draft = llm_result.get("event", {})
+            return {
+                "concepts": cleaned_llm,
+                # Already lowercased and stripped, so dedupe here and let
+                # normalize_concepts skip its own pass.
+                "normalized_concepts": list(dict.fromkeys(cleaned_llm)),
+                "learning_event_draft": draft if isinstance(draft, dict) else {},
+                "llm_used": True,
+                "llm_status": "ok",
+            }
+
+    words = _WORD_RE.findall(text)
+    filtered = [w for w in words if w not in _FALLBACK_STOPWORDS]
     freq = Counter(filtered)
     concepts = [word for word, _ in freq.most_common(12)]
     if not concepts:
         concepts = ["core-topic", "key-idea", "review-focus"]
-    return {**state, "concepts": concepts, "llm_status": llm_status}
+    return {"concepts": concepts, "llm_status": llm_status}
 
 
-@traceable(run_type="chain", name="normalize_concepts")
+@traceable(run_type="chain", name="normalize_concepts", tags=["pipeline", "concepts"])
 def normalize_concepts(state: PipelineState) -> PipelineState:
+    existing = state.get("normalized_concepts", [])
+    if existing:
+        return {"normalized_concepts": existing}
     seen = set()
     normalized = []
     for concept in state.get("concepts", []):
@@ -368,23 +586,23 @@ def normalize_concepts(state: PipelineState) -> PipelineState:
         if value and value not in seen:
             seen.add(value)
             normalized.append(value)
-    return {**state, "normalized_concepts": normalized}
+    return {"normalized_concepts": normalized}
 
 
-@traceable(run_type="chain", name="estimate_priority")
+@traceable(run_type="chain", name="estimate_priority", tags=["pipeline", "concepts"])
 def estimate_priority(state: PipelineState) -> PipelineState:
     normalized = state.get("normalized_concepts", [])
     if not normalized:
-        return {**state, "priority_concepts": []}
+        return {"priority_concepts": []}
 
     # Keep broad concept coverage while preserving ranking order from concept extraction.
     # Target: at least 85% of detected concepts, capped to 10 topics.
     coverage_target = max(1, min(10, int(math.ceil(len(normalized) * 0.85))))
     priority = normalized[:coverage_target]
-    return {**state, "priority_concepts": priority}
+    return {"priority_concepts": priority}
 
 
-@traceable(run_type="chain", name="select_scenario_seed")
+@traceable(run_type="chain", name="select_scenario_seed", tags=["pipeline", "concepts"])
 def select_scenario_seed(state: PipelineState) -> PipelineState:
     priority = state.get("priority_concepts", [])
     seed = {
@@ -392,7 +610,7 @@ def select_scenario_seed(state: PipelineState) -> PipelineState:
         "secondary": priority[1:],
         "mode": "deterministic-placeholder",
     }
-    return {**state, "scenario_seed": seed}
+    return {"scenario_seed": seed}
 
 
 def _coverage_target(total: int, ratio: float = 0.85) -> int:
@@ -419,7 +637,7 @@ def _normalized_subtopic_checklist(
     seen: set[str] = set()
 
     for raw_item in llm_items:
-        item = re.sub(r"^\s*[-*\d\).\]]+\s*", "", str(raw_item)).strip()
+        item = _LIST_MARKER_RE.sub("", str(raw_item)).strip()
         if len(item) < 4:
             continue
         key = item.lower()
@@ -477,7 +695,7 @@ def _match_topic_to_concept(raw_topic: str, concepts: list[str], used: set[str])
 
 
 def _word_count(text: str) -> int:
-    return len(re.findall(r"\S+", text))
+    return len(_NON_SPACE_RE.findall(text))
 
 
 def _ensure_min_words(text: str, min_words: int, topic_label: str) -> str:
@@ -506,6 +724,23 @@ def _pair_topics(concepts: list[str]) -> list[list[str]]:
     return pairs
 
 
+def _draft_covers_pairs(draft: dict[str, Any], pairs: list[list[str]]) -> bool:
+    """True when the draft has a story card whose topics are exactly each pair."""
+    cards = draft.get("story_cards", [])
+    if not isinstance(cards, list):
+        return False
+    drafted: set[tuple[str, ...]] = set()
+    for card in cards:
+        if not isinstance(card, dict):
+            continue
+        topics = card.get("topics", [])
+        if isinstance(topics, str):
+            topics = [topics]
+        if isinstance(topics, list):
+            drafted.add(tuple(sorted(str(topic).strip().lower() for topic in topics)))
+    return all(tuple(sorted(topic.lower() for topic in pair)) in drafted for pair in pairs)
+
+
 def _story_min_words(importance: str) -> int:
     if importance == "high":
         return 620
@@ -545,7 +780,7 @@ def _normalize_micro_explanations(raw: Any, fallback: list[str]) -> list[str]:
     )
     out: list[str] = []
     for text in candidates[:2]:
-        trimmed = re.sub(r"\s+", " ", text).strip()
+        trimmed = _WHITESPACE_RE.sub(" ", text).strip()
         if len(trimmed) > 320:
             trimmed = trimmed[:317].rstrip() + "..."
         if trimmed:
@@ -941,7 +1176,7 @@ def _compose_story_text(
     )
 
 
-@traceable(run_type="chain", name="generate_learning_event")
+@traceable(run_type="chain", name="generate_learning_event", tags=["pipeline", "story", "llm"])
 def generate_learning_event(state: PipelineState) -> PipelineState:
     seed = state.get("scenario_seed", {})
     all_concepts = [str(c).strip() for c in state.get("normalized_concepts", []) if str(c).strip()]
@@ -976,72 +1211,38 @@ def generate_learning_event(state: PipelineState) -> PipelineState:
     secondary = [c for c in concepts if c.lower() != focus.lower()]
     topic_pairs = _pair_topics(concepts)
 
-    llm_result, llm_status = _llm_json(
-        system_prompt=(
-            "You are an expert educational story writer and exam-prep learning designer. "
-            "Your output must be story-driven, exam-focused, and conversational. "
-            "Never invent topics not present in the source text or provided concept list. "
-            "Return valid JSON only."
-        ),
-        user_prompt=(
-            "Task: build story-driven scenario cards for exam revision using topic PAIRS only.\n"
-            "Goal: each card should feel like a focused exam-night scene (story first), then a checkpoint quiz.\n\n"
-            "Hard constraints:\n"
-            "1) Create exactly one story_card for each pair in TOPIC_PAIRS.\n"
-            "2) topics in each story_card must be exactly the same as one given pair.\n"
-            "3) importance must be one of: high, medium, low.\n"
-            "4) story must be substantial (at least 320 words) and align with the same concepts.\n"
-            "5) each story must show progression: setup -> struggle -> correction -> takeaway.\n"
-            "6) include micro_explanations with 2-4 short beats derived from the story (for slide rendering).\n"
-            "7) Include one checkpoint quiz in each story_card.\n"
-            "8) quiz must contain: question, options (3-4), correct_index, explanation, misconception, focus_concept, open_question, open_model_answer.\n"
-            "9) Add friend_explainers as natural conversational prompts (2-3 lines).\n"
-            "10) Keep output practical for exam prep and avoid fluff.\n"
-            "11) Do not invent extra topics or extra subtopics beyond provided concepts.\n"
-            "12) checklist must be concise and exam actionable.\n\n"
-            "13) Write in second-person voice (you/your).\n"
-            "14) Avoid textbook tone and avoid keyword dumping.\n\n"
-            "Writing style:\n"
-            "- energetic, clear, and focused\n"
-            "- cinematic but practical exam-night delivery\n"
-            "- concrete examples and reasoning steps\n\n"
-            "Return JSON with exact keys:\n"
-            "{"
-            "\"title\": str, "
-            "\"storytelling\": str, "
-            "\"story_cards\": ["
-            "{"
-            "\"title\": str, "
-            "\"topics\": [str, ...], "
-            "\"importance\": \"high\"|\"medium\"|\"low\", "
-            "\"subtopics\": [str, ...], "
-            "\"micro_explanations\": [str, ...], "
-            "\"story\": str, "
-            "\"friend_explainers\": [str, ...], "
-            "\"quiz\": {"
-            "\"question\": str, "
-            "\"options\": [str, ...], "
-            "\"correct_index\": int, "
-            "\"explanation\": str, "
-            "\"misconception\": str, "
-            "\"focus_concept\": str, "
-            "\"open_question\": str, "
-            "\"open_model_answer\": str"
-            "}"
-            "}, ..."
-            "], "
-            "\"subtopics\": [str, str, ...], "
-            "\"checklist\": [str, ...], "
-            "\"opening\": str, "
-            "\"checkpoint\": str, "
-            "\"boss_level\": str"
-            "}\n"
-            "No markdown. No extra keys. No commentary.\n\n"
-            f"CONCEPTS: {concepts}\n\n"
-            f"TOPIC_PAIRS: {topic_pairs}\n\n"
-            f"SOURCE TEXT:\n{state.get('cleaned_text', '')[:12000]}"
-        ),
+    # The draft was written before dedupe and the priority cap were applied, so only
+    # reuse it when its cards line up with the pairs used here.
+    draft = state.get("learning_event_draft", {})
+    reuse_draft = isinstance(draft, dict) and bool(draft) and _draft_covers_pairs(draft, topic_pairs)
+    _trace_metadata(
+        concept_count=len(concepts),
+        text_len=len(state.get("cleaned_text", "")),
+        draft_reused=reuse_draft,
+        model=_llm_model(),
     )
+    if reuse_draft:
+        llm_result, llm_status = draft, "ok"
+    else:
+        llm_result, llm_status = _llm_json(
+            system_prompt=(
+                "You are an expert educational story writer and exam-prep learning designer. "
+                "Your output must be story-driven, exam-focused, and conversational. "
+                "Never invent topics not present in the source text or provided concept list. "
+                "Return valid JSON only."
+            ),
+            user_prompt=(
+                "Task: build story-driven scenario cards for exam revision using topic PAIRS only.\n"
+                f"{_STORY_GOAL}"
+                f"{_STORY_RULES}"
+                "Return JSON with exact keys:\n"
+                f"{_STORY_SCHEMA}\n"
+                "No markdown. No extra keys. No commentary.\n\n"
+                f"CONCEPTS: {concepts}\n\n"
+                f"TOPIC_PAIRS: {topic_pairs}\n\n"
+                f"SOURCE TEXT:\n{state.get('cleaned_text', '')[:_LLM_SOURCE_CHARS]}"
+            ),
+        )
     if llm_result:
         title = str(llm_result.get("title", f"LastMinute Mission: {focus}")).strip()
         storytelling_summary = str(llm_result.get("storytelling", "")).strip()
@@ -1099,7 +1300,6 @@ def generate_learning_event(state: PipelineState) -> PipelineState:
             "coverage_ratio": round(len(concepts) / max(len(all_concepts), 1), 3),
         }
         return {
-            **state,
             "learning_event": event,
             "todo_checklist": checklist,
             "interactive_story": story,
@@ -1149,7 +1349,6 @@ def generate_learning_event(state: PipelineState) -> PipelineState:
         "coverage_ratio": round(len(concepts) / max(len(all_concepts), 1), 3),
     }
     return {
-        **state,
         "learning_event": event,
         "todo_checklist": checklist,
         "interactive_story": story,
@@ -1158,6 +1357,7 @@ def generate_learning_event(state: PipelineState) -> PipelineState:
     }
 
 
+@functools.lru_cache(maxsize=None)
 def _get_api_key() -> str:
     """Return the Gemini/Google API key from env or .env files."""
     return (
@@ -1169,15 +1369,127 @@ def _get_api_key() -> str:
 
 
 _IMG_LOCK = threading.Lock()
-_IMG_LAST_CALL = 0.0
-_IMG_MIN_INTERVAL = 4.0
+_IMG_WINDOW: deque[float] = deque()
+_IMG_WINDOW_SECONDS = 60.0
+_IMG_RPM = 10
 _IMG_MAX_RETRIES = 4
 _IMG_BASE_BACKOFF = 5.0
+_IMG_DIAGRAM_STYLE = (
+    "Style: crisp vector-style illustration, high clarity, bold shapes. "
+    "Each element must have a UNIQUE icon or shape. No placeholder text."
+)
+_IMG_RENDER_SUFFIX = (
+    "Render as a single, high-clarity diagram: crisp lines, "
+    "distinct elements, no blur. Each concept must have a "
+    "unique visual — no repeated icons or duplicate labels. "
+    "No placeholder or lorem ipsum text."
+)
+
+# One pooled session so image calls reuse keep-alive connections to the Gemini host. The
+# pool holds a connection per concurrent request allowed by the rate limiter.
+if _http is not None:
+    _HTTP_SESSION = _http.Session()
+    _HTTP_SESSION.mount("https://", _http.adapters.HTTPAdapter(pool_maxsize=_IMG_RPM))
+else:
+    _HTTP_SESSION = None
+
+
+def _img_rate_limit_wait() -> None:
+    """Block until the sliding one-minute window has room for another image request."""
+    with _IMG_LOCK:
+        while True:
+            now = time.monotonic()
+            while _IMG_WINDOW and now - _IMG_WINDOW[0] >= _IMG_WINDOW_SECONDS:
+                _IMG_WINDOW.popleft()
+            if len(_IMG_WINDOW) < _IMG_RPM:
+                _IMG_WINDOW.append(now)
+                return
+            time.sleep(_IMG_WINDOW_SECONDS - (now - _IMG_WINDOW[0]))
+
+
+def _image_cache_path(image_model: str, prompt_text: str) -> str:
+    key = hashlib.sha256(f"{image_model}\n{prompt_text}".encode("utf-8")).hexdigest()
+    return os.path.join(os.getcwd(), ".cache", "images", f"{key}.b64")
+
+
+def _image_cache_get(path: str) -> str | None:
+    if not _cache_enabled():
+        return None
+    ttl = _cache_ttl_seconds()
+    if ttl == 0:
+        return None
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path, "r", encoding="ascii") as file:
+            value = file.read()
+        return value or None
+    except Exception:
+        return None
+
+
+def _image_cache_set(path: str, data_uri: str) -> None:
+    if not _cache_enabled() or _cache_ttl_seconds() == 0:
+        return
+    # Image jobs run on a thread pool, so the temp name must be unique per thread too.
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "w", encoding="ascii") as file:
+            file.write(data_uri)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        except Exception:
+            pass
+
+
+_INLINE_DATA_RE = re.compile(rb'"inlineData"\s*:\s*\{')
+_INLINE_B64_RE = re.compile(rb'"data"\s*:\s*"([A-Za-z0-9+/=]+)"')
+_INLINE_MIME_RE = re.compile(rb'"mimeType"\s*:\s*"([^"\\]+)"')
+
+
+def _scan_inline_image(body: bytes) -> tuple[str, str] | None:
+    """Pull the first inlineData image out of a raw response body without building the JSON tree.
+
+    Returns None when the body has no well-formed inline image, so callers can fall back to
+    a full parse (which also surfaces API errors).
+    """
+    start = _INLINE_DATA_RE.search(body)
+    if start is None:
+        return None
+    data_match = _INLINE_B64_RE.search(body, start.end())
+    if data_match is None:
+        return None
+    head = body[start.end() : data_match.start()]
+    if b"}" in head:
+        return None
+    mime_match = _INLINE_MIME_RE.search(head)
+    if mime_match is None:
+        tail_end = body.find(b"}", data_match.end())
+        if tail_end != -1:
+            mime_match = _INLINE_MIME_RE.search(body, data_match.end(), tail_end)
+    mime = mime_match.group(1).decode("ascii", "replace") if mime_match else "image/png"
+    return mime, data_match.group(1).decode("ascii")
+
+
+def _extract_inline_image(data: dict[str, Any]) -> tuple[str, str] | None:
+    """Return (mime, base64 data) of the first inline image in a generateContent response."""
+    candidates = data.get("candidates", [])
+    if not candidates:
+        return None
+    parts = candidates[0].get("content", {}).get("parts", [])
+    for part in parts:
+        inline = part.get("inlineData")
+        if inline and inline.get("data"):
+            return inline.get("mimeType", "image/png"), inline["data"]
+    return None
 
 
 def _generate_image(description: str) -> str | None:
     """Call Gemini image generation API with retry + rate limiting."""
-    global _IMG_LAST_CALL
     api_key = _get_api_key()
     if not api_key:
         _log.warning("Image gen skipped: no GEMINI_API_KEY / GOOGLE_API_KEY")
@@ -1202,19 +1514,18 @@ def _generate_image(description: str) -> str | None:
         "https://generativelanguage.googleapis.com/v1beta/models/"
         f"{image_model}:generateContent?key={api_key}"
     )
+    prompt_text = f"{description} {_IMG_RENDER_SUFFIX}"
+    cache_path = _image_cache_path(image_model, prompt_text)
+    cached = _image_cache_get(cache_path)
+    if cached is not None:
+        return cached
     # API requires uppercase: ["TEXT", "IMAGE"] (case-sensitive).
     payload = {
         "contents": [
             {
                 "parts": [
                     {
-                        "text": (
-                            f"{description} "
-                            "Render as a single, high-clarity diagram: crisp lines, "
-                            "distinct elements, no blur. Each concept must have a "
-                            "unique visual — no repeated icons or duplicate labels. "
-                            "No placeholder or lorem ipsum text."
-                        )
+                        "text": prompt_text
                     }
                 ]
             }
@@ -1223,14 +1534,9 @@ def _generate_image(description: str) -> str | None:
     }
     last_error: str | None = None
     for attempt in range(_IMG_MAX_RETRIES):
-        with _IMG_LOCK:
-            now = time.monotonic()
-            wait = _IMG_MIN_INTERVAL - (now - _IMG_LAST_CALL)
-            if wait > 0:
-                time.sleep(wait)
-            _IMG_LAST_CALL = time.monotonic()
+        _img_rate_limit_wait()
         try:
-            resp = _http.post(url, json=payload, timeout=90)
+            resp = _HTTP_SESSION.post(url, json=payload, timeout=90)
             if resp.status_code in (429, 500, 502, 503):
                 last_error = f"status={resp.status_code} body={resp.text[:500]}"
                 _log.warning("Image gen attempt %s: %s", attempt + 1, last_error)
@@ -1240,24 +1546,33 @@ def _generate_image(description: str) -> str | None:
                 last_error = f"status={resp.status_code} body={resp.text[:800]}"
                 _log.warning("Image gen failed: %s", last_error)
                 return None
-            data = resp.json()
-            # Check for API error in JSON (e.g. blocked, model not found)
-            if "error" in data:
-                last_error = str(data.get("error", data))[:500]
-                _log.warning("Image gen API error: %s", last_error)
-                return None
-            candidates = data.get("candidates", [])
-            if not candidates:
-                _log.warning("Image gen: no candidates in response")
-                return None
-            parts = candidates[0].get("content", {}).get("parts", [])
-            for part in parts:
-                inline = part.get("inlineData")
-                if inline and inline.get("data"):
-                    mime = inline.get("mimeType", "image/png")
-                    return f"data:{mime};base64,{inline['data']}"
-            _log.warning("Image gen: no inlineData in candidate parts")
-            return None
+            body = resp.content
+            # Drop the response object now; only the raw body is needed from here on.
+            resp = None
+            inline = _scan_inline_image(body)
+            if inline is None:
+                data = _json_loads(body)
+                body = None
+                # Check for API error in JSON (e.g. blocked, model not found)
+                if "error" in data:
+                    last_error = str(data.get("error", data))[:500]
+                    _log.warning("Image gen API error: %s", last_error)
+                    return None
+                if not data.get("candidates"):
+                    _log.warning("Image gen: no candidates in response")
+                    return None
+                inline = _extract_inline_image(data)
+                data = None
+                if inline is None:
+                    _log.warning("Image gen: no inlineData in candidate parts")
+                    return None
+            # Release the body before formatting so only the base64 text and the
+            # data URI are alive at the same time.
+            body = None
+            mime, b64 = inline
+            data_uri = f"data:{mime};base64,{b64}"
+            _image_cache_set(cache_path, data_uri)
+            return data_uri
         except Exception as e:
             last_error = str(e)
             _log.warning("Image gen exception: %s", last_error)
@@ -1266,13 +1581,13 @@ def _generate_image(description: str) -> str | None:
     return None
 
 
-@traceable(run_type="chain", name="generate_story_visuals")
+@traceable(run_type="chain", name="generate_story_visuals", tags=["pipeline", "visuals", "image"])
 def generate_story_visuals(state: PipelineState) -> PipelineState:
     """Generate a small number of visuals tied to explanation beats per topic card."""
     story = state.get("interactive_story", {})
     topic_cards = story.get("topic_storylines", []) if isinstance(story, dict) else []
     if not isinstance(topic_cards, list) or not topic_cards:
-        return {**state, "story_beats": []}
+        return {"story_beats": []}
 
     raw_max = os.getenv("LASTMINUTE_MAX_VISUALS_PER_TOPIC", "").strip()
     try:
@@ -1281,7 +1596,7 @@ def generate_story_visuals(state: PipelineState) -> PipelineState:
         max_visuals_per_topic = 2
     max_visuals_per_topic = max(0, min(4, max_visuals_per_topic))
     if max_visuals_per_topic == 0:
-        return {**state, "story_beats": []}
+        return {"story_beats": []}
 
     beats: list[dict[str, Any]] = []
     for idx, card in enumerate(topic_cards):
@@ -1298,13 +1613,13 @@ def generate_story_visuals(state: PipelineState) -> PipelineState:
             micro = []
         if not micro:
             story_text = str(card.get("story", "")).strip()
-            parts = [p.strip() for p in re.split(r"(?<=[.!?])\s+", story_text) if p.strip()]
+            parts = [p.strip() for p in _SENT_SPLIT_RE.split(story_text) if p.strip()]
             micro = parts[:2] if parts else [f"Core explanation for {label}."]
         micro = micro[:max_visuals_per_topic]
 
         image_steps: list[dict[str, Any]] = []
         for exp_idx, explanation in enumerate(micro):
-            clean_explanation = re.sub(r"\s+", " ", explanation).strip()
+            clean_explanation = _WHITESPACE_RE.sub(" ", explanation).strip()
             prompt = (
                 f"Teach {label} with one concise educational visual. "
                 f"Support this explanation beat: {clean_explanation}. "
@@ -1332,11 +1647,7 @@ def generate_story_visuals(state: PipelineState) -> PipelineState:
     def _gen_step_image(beat_idx: int, step_idx: int, prompt_text: str) -> tuple[int, int, str | None]:
         if not prompt_text:
             return beat_idx, step_idx, None
-        full_prompt = (
-            f"Create a single, clear educational diagram: {prompt_text}. "
-            "Style: crisp vector-style illustration, high clarity, bold shapes. "
-            "Each element must have a UNIQUE icon or shape. No placeholder text."
-        )
+        full_prompt = f"Create a single, clear educational diagram: {prompt_text}. {_IMG_DIAGRAM_STYLE}"
         return beat_idx, step_idx, _generate_image(full_prompt)
 
     jobs: list[tuple[int, int, str]] = []
@@ -1344,8 +1655,9 @@ def generate_story_visuals(state: PipelineState) -> PipelineState:
         for si, step in enumerate(beat["image_steps"]):
             if step.get("prompt"):
                 jobs.append((bi, si, step["prompt"]))
+    _trace_metadata(beat_count=len(beats), image_jobs=len(jobs))
 
-    with ThreadPoolExecutor(max_workers=2) as pool:
+    with ThreadPoolExecutor(max_workers=max(1, min(_IMG_RPM, len(jobs)))) as pool:
         futures = [pool.submit(_gen_step_image, bi, si, p) for bi, si, p in jobs]
         for future in as_completed(futures):
             try:
@@ -1355,7 +1667,7 @@ def generate_story_visuals(state: PipelineState) -> PipelineState:
             except Exception:
                 pass
 
-    return {**state, "story_beats": beats}
+    return {"story_beats": beats}
 
 
 def build_graph():
@@ -1374,9 +1686,11 @@ def build_graph():
     graph.set_entry_point("store_raw_files")
     graph.add_edge("store_raw_files", "extract_text")
     graph.add_edge("extract_text", "clean_text")
+    # chunk_text and concept_extraction both read only cleaned_text, so they run in the
+    # same step; normalize_concepts waits for both.
     graph.add_edge("clean_text", "chunk_text")
-    graph.add_edge("chunk_text", "concept_extraction")
-    graph.add_edge("concept_extraction", "normalize_concepts")
+    graph.add_edge("clean_text", "concept_extraction")
+    graph.add_edge(["chunk_text", "concept_extraction"], "normalize_concepts")
     graph.add_edge("normalize_concepts", "estimate_priority")
     graph.add_edge("estimate_priority", "select_scenario_seed")
     graph.add_edge("select_scenario_seed", "generate_learning_event")
@@ -1388,9 +1702,8 @@ def build_graph():
 PIPELINE_GRAPH = build_graph()
 
 
-@traceable(run_type="chain", name="run_pipeline")
-def run_pipeline(raw_files: list, extracted_text: str = "") -> PipelineState:
-    initial_state: PipelineState = {
+def _initial_state(raw_files: list, extracted_text: str) -> PipelineState:
+    return {
         "raw_files": raw_files,
         "extracted_text": extracted_text,
         "cleaned_text": "",
@@ -1404,10 +1717,23 @@ def run_pipeline(raw_files: list, extracted_text: str = "") -> PipelineState:
         "interactive_story": {},
         "final_storytelling": "",
         "story_beats": [],
+        "learning_event_draft": {},
         "llm_used": False,
         "llm_status": "",
     }
-    return PIPELINE_GRAPH.invoke(initial_state)
+
+
+@traceable(run_type="chain", name="run_pipeline", tags=["pipeline"])
+def run_pipeline(raw_files: list, extracted_text: str = "") -> PipelineState:
+    _trace_metadata(file_count=len(raw_files), text_len=len(extracted_text))
+    return PIPELINE_GRAPH.invoke(_initial_state(raw_files, extracted_text))
+
+
+@traceable(run_type="chain", name="arun_pipeline", tags=["pipeline"])
+async def arun_pipeline(raw_files: list, extracted_text: str = "") -> PipelineState:
+    """Async form of run_pipeline for callers that overlap the run with their own I/O."""
+    _trace_metadata(file_count=len(raw_files), text_len=len(extracted_text))
+    return await PIPELINE_GRAPH.ainvoke(_initial_state(raw_files, extracted_text))
 
 
 def _state_preview_value(value: Any) -> Any:
@@ -1425,54 +1751,63 @@ def _state_preview_value(value: Any) -> Any:
     return value
 
 
-@traceable(run_type="chain", name="run_pipeline_with_trace")
-def run_pipeline_with_trace(
+def run_pipeline_streaming(
     raw_files: list, extracted_text: str = ""
-) -> tuple[PipelineState, list[dict[str, Any]]]:
-    initial_state: PipelineState = {
-        "raw_files": raw_files,
-        "extracted_text": extracted_text,
-        "cleaned_text": "",
-        "chunks": [],
-        "concepts": [],
-        "normalized_concepts": [],
-        "priority_concepts": [],
-        "scenario_seed": {},
-        "learning_event": {},
-        "todo_checklist": [],
-        "interactive_story": {},
-        "final_storytelling": "",
-        "story_beats": [],
-        "llm_used": False,
-        "llm_status": "",
-    }
+) -> Iterator[dict[str, Any]]:
+    """Run the graph and yield one trace entry per node update as it happens.
 
-    current_state: dict[str, Any] = dict(initial_state)
-    trace: list[dict[str, Any]] = []
+    Consumers that forward entries (logs, SSE) keep memory flat instead of holding the
+    whole trace.
+    """
+    yield from _stream_pipeline(dict(_initial_state(raw_files, extracted_text)))
+
+
+def _stream_pipeline(current_state: dict[str, Any]) -> Iterator[dict[str, Any]]:
+    """Stream the graph from current_state, merging every node update back into it."""
+    initial_state = dict(current_state)
+    # Previews of unchanged keys carry over between steps; only the fields a node
+    # updated are re-rendered.
+    preview: dict[str, Any] = {
+        key: _state_preview_value(value) for key, value in current_state.items()
+    }
 
     for update in PIPELINE_GRAPH.stream(initial_state, stream_mode="updates"):
-        if not isinstance(update, dict):
+        # Accept any mapping; nodes that wrote nothing stream as None and are skipped.
+        try:
+            node_updates = update.items()
+        except AttributeError:
             continue
-        for node_name, node_update in update.items():
-            if not isinstance(node_update, dict):
+        for node_name, node_update in node_updates:
+            try:
+                updated_items = node_update.items()
+            except AttributeError:
                 continue
-            current_state.update(node_update)
-            trace.append(
-                {
-                    "node": node_name,
-                    "updated_fields": list(node_update.keys()),
-                    "state_preview": {
-                        key: _state_preview_value(current_state.get(key))
-                        for key in current_state.keys()
-                    },
-                }
-            )
+            if not updated_items:
+                continue
+            for key, value in updated_items:
+                current_state[key] = value
+                preview[key] = _state_preview_value(value)
+            # A shallow copy of the ~16 state keys is cheaper than a persistent map here;
+            # the previews themselves are shared, not copied.
+            yield {
+                "node": node_name,
+                "updated_fields": tuple(node_update),
+                "state_preview": dict(preview),
+            }
+
 
-    final_state = PIPELINE_GRAPH.invoke(initial_state)
+@traceable(run_type="chain", name="run_pipeline_with_trace", tags=["pipeline", "debug"])
+def run_pipeline_with_trace(
+    raw_files: list, extracted_text: str = ""
+) -> tuple[PipelineState, list[dict[str, Any]]]:
+    _trace_metadata(file_count=len(raw_files), text_len=len(extracted_text))
+    # The merged stream updates are the final state; no second graph run is needed.
+    final_state: dict[str, Any] = dict(_initial_state(raw_files, extracted_text))
+    trace = list(_stream_pipeline(final_state))
     return final_state, trace
 
 
-if __name__ == "__main__":
+def _demo() -> None:
     sample = """
     Page 1
     Newton's second law explains force, mass, and acceleration.
@@ -1480,4 +1815,8 @@ if __name__ == "__main__":
     Practice free-body diagrams for exam problems.
     """
     result = run_pipeline(["syllabus.pdf", "week1_notes.md"], extracted_text=sample)
-    print(json.dumps(result, indent=2))
+    print(_json_dumps_pretty(result))
+
+
+if __name__ == "__main__":
+    _demo()